@@ -0,0 +1,173 @@
+import os
+import asyncio
+import hashlib
+import logging
+import tarfile
+import zipfile
+from urllib.parse import quote
+from aiohttp import web
+
+log = logging.getLogger('archive')
+
+CHUNK_SIZE = 256 * 1024
+ARCHIVE_FORMATS = ('zip', 'tar')
+
+class ArchiveMember:
+    def __init__(self, path, name):
+        st = os.stat(path)
+        self.path = path
+        self.name = name
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+
+class _ChunkWriter:
+    """Unseekable file object which collects everything zipfile writes, so it can be handed to the response."""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+async def _read_chunks(path, offset, length):
+    loop = asyncio.get_running_loop()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            chunk = await loop.run_in_executor(None, f.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                raise RuntimeError(f'"{path}" was truncated while being archived')
+            length -= len(chunk)
+            yield chunk
+
+def _tar_segments(members):
+    """Lays out a tar archive as a list of literal byte strings and file members.
+
+    Every tar header and file size is known upfront, so the total length of the archive is too,
+    which lets us announce a Content-Length and serve byte ranges without building the archive.
+    """
+    segments = []
+    for member in members:
+        info = tarfile.TarInfo(member.name)
+        info.size = member.size
+        info.mtime = int(member.mtime)
+        info.mode = 0o644
+        segments.append(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        segments.append(member)
+        remainder = member.size % tarfile.BLOCKSIZE
+        if remainder:
+            segments.append(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    segments.append(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+    return segments
+
+def _segment_size(segment):
+    return segment.size if isinstance(segment, ArchiveMember) else len(segment)
+
+def _etag(members):
+    digest = hashlib.sha1()
+    for member in members:
+        digest.update(f'{member.name}\0{member.size}\0{member.mtime}\0'.encode('utf-8', 'surrogateescape'))
+    return f'"{digest.hexdigest()}"'
+
+def _requested_range(request, etag, total):
+    """Returns the (start, end) byte range to serve, or None if the whole archive should be sent.
+
+    Malformed or multi-part ranges are ignored, as permitted by RFC 9110.
+    """
+    if 'Range' not in request.headers:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range != etag:
+        return None
+    try:
+        rng = request.http_range
+    except ValueError:
+        return None
+    start, end = rng.start, rng.stop
+    if start is None:
+        return None
+    if start < 0:
+        start = max(total + start, 0)
+    if end is None or end > total:
+        end = total
+    if start >= total:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{total}'})
+    return start, end
+
+async def _stream_tar(request, response, members):
+    segments = _tar_segments(members)
+    total = sum(_segment_size(s) for s in segments)
+    etag = _etag(members)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['ETag'] = etag
+    start, end = 0, total
+    rng = _requested_range(request, etag, total)
+    if rng is not None:
+        start, end = rng
+        response.set_status(206)
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{total}'
+    response.content_length = end - start
+    await response.prepare(request)
+
+    offset = 0
+    for segment in segments:
+        size = _segment_size(segment)
+        if offset + size > start and offset < end:
+            lo = max(start - offset, 0)
+            hi = min(end - offset, size)
+            if isinstance(segment, ArchiveMember):
+                async for chunk in _read_chunks(segment.path, lo, hi - lo):
+                    await response.write(chunk)
+            else:
+                await response.write(segment[lo:hi])
+        offset += size
+        if offset >= end:
+            break
+
+async def _stream_zip(request, response, members):
+    # CRCs are only known once each file has been read, so a zip cannot be resumed part-way
+    response.headers['Accept-Ranges'] = 'none'
+    await response.prepare(request)
+
+    writer = _ChunkWriter()
+    with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for member in members:
+            zinfo = zipfile.ZipInfo.from_file(member.path, member.name, strict_timestamps=False)
+            with zf.open(zinfo, 'w') as dest:
+                async for chunk in _read_chunks(member.path, 0, member.size):
+                    dest.write(chunk)
+                    await response.write(writer.take())
+            await response.write(writer.take())
+    await response.write(writer.take())
+
+async def stream_archive(request, members, format, name):
+    """Streams the given members to the client as an uncompressed zip or tar archive.
+
+    Files are read in chunks of CHUNK_SIZE and written out as they are read, so memory use does not
+    depend on the size of the archive and nothing is written to disk.
+    """
+    filename = quote(f'{name}.{format}')
+    response = web.StreamResponse(headers={
+        'Content-Type': 'application/zip' if format == 'zip' else 'application/x-tar',
+        'Content-Disposition': f"attachment; filename*=UTF-8''{filename}",
+    })
+    log.info(f'streaming {len(members)} files as {name}.{format}')
+    if format == 'zip':
+        await _stream_zip(request, response, members)
+    else:
+        await _stream_tar(request, response, members)
+    await response.write_eof()
+    return response
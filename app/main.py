@@ -8,8 +8,13 @@ import socketio
 import logging
 import json
 import pathlib
+import asyncio
+import hmac
 
 from ytdl import DownloadQueueNotifier, DownloadQueue
+from archive import ArchiveMember, ARCHIVE_FORMATS, stream_archive
+from worker import Worker
+from subscriptions import SubscriptionManager
 
 log = logging.getLogger('main')
 
@@ -31,10 +36,24 @@ class Config:
         'HOST': '0.0.0.0',
         'PORT': '8081',
         'BASE_DIR': '',
-        'DEFAULT_THEME': 'auto'
+        'DEFAULT_THEME': 'auto',
+        'LOCAL_DOWNLOADS': 'true',
+        'WORKER_TOKEN': '',
+        'WORKER_LEASE_TIMEOUT': '30',
+        'MANAGER_URL': '',
+        'WORKER_ID': '',
+        'WORKER_POLL_INTERVAL': '5',
+        'WORKER_HEARTBEAT_INTERVAL': '2',
+        'SUBSCRIPTION_INTERVAL': '3600',
+        'SUBSCRIPTION_JITTER': '0.1',
+        'SUBSCRIPTION_HOST_CONCURRENCY': '1',
+        'SUBSCRIPTION_MAX_ENTRIES': '100',
     }
 
-    _BOOLEAN = ('DOWNLOAD_DIRS_INDEXABLE', 'CUSTOM_DIRS', 'CREATE_CUSTOM_DIRS', 'DELETE_FILE_ON_TRASHCAN')
+    _BOOLEAN = ('DOWNLOAD_DIRS_INDEXABLE', 'CUSTOM_DIRS', 'CREATE_CUSTOM_DIRS', 'DELETE_FILE_ON_TRASHCAN', 'LOCAL_DOWNLOADS')
+
+    # Not sent to the frontend
+    _PRIVATE = ('WORKER_TOKEN',)
 
     def __init__(self):
         for k, v in self._DEFAULTS.items():
@@ -73,8 +92,18 @@ class Config:
                 sys.exit(1)
             self.YTDL_OPTIONS.update(opts)
 
+        if (self.MANAGER_URL or not self.LOCAL_DOWNLOADS) and not self.WORKER_TOKEN:
+            log.error('WORKER_TOKEN is required when using remote download workers')
+            sys.exit(1)
+
 config = Config()
 
+if __name__ == '__main__' and config.MANAGER_URL:
+    # Worker mode: no web server and no queue of our own, downloads are pulled from the manager
+    logging.basicConfig(level=logging.DEBUG)
+    asyncio.run(Worker(config).run())
+    sys.exit(0)
+
 class ObjectSerializer(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, object):
@@ -106,6 +135,8 @@ class Notifier(DownloadQueueNotifier):
 
 dqueue = DownloadQueue(config, Notifier())
 app.on_startup.append(lambda app: dqueue.initialize())
+subscriptions = SubscriptionManager(config, dqueue)
+app.on_startup.append(lambda app: subscriptions.initialize())
 
 @routes.post(config.URL_PREFIX + 'add')
 async def add(request):
@@ -142,6 +173,47 @@ async def start(request):
     status = await dqueue.start_pending(ids)
     return web.Response(text=serializer.encode(status))
 
+@routes.post(config.URL_PREFIX + 'subscribe')
+async def subscribe(request):
+    post = await request.json()
+    url = post.get('url')
+    quality = post.get('quality')
+    if not url or not quality:
+        raise web.HTTPBadRequest()
+    format = post.get('format')
+    folder = post.get('folder')
+    custom_name_prefix = post.get('custom_name_prefix')
+    interval = post.get('interval')
+    download_existing = post.get('download_existing')
+    if custom_name_prefix is None:
+        custom_name_prefix = ''
+    if interval is not None and (not isinstance(interval, (int, float)) or interval <= 0):
+        raise web.HTTPBadRequest()
+    status = await subscriptions.subscribe(url, quality, format, folder, custom_name_prefix, interval, bool(download_existing))
+    return web.Response(text=serializer.encode(status))
+
+@routes.post(config.URL_PREFIX + 'unsubscribe')
+async def unsubscribe(request):
+    post = await request.json()
+    ids = post.get('ids')
+    if not ids:
+        raise web.HTTPBadRequest()
+    status = await subscriptions.unsubscribe(ids)
+    return web.Response(text=serializer.encode(status))
+
+@routes.post(config.URL_PREFIX + 'subscriptions/check')
+async def check_subscriptions(request):
+    post = await request.json()
+    ids = post.get('ids')
+    if not ids:
+        raise web.HTTPBadRequest()
+    status = await subscriptions.check_now(ids)
+    return web.Response(text=serializer.encode(status))
+
+@routes.get(config.URL_PREFIX + 'subscriptions')
+async def get_subscriptions(request):
+    return web.Response(text=serializer.encode(subscriptions.get()))
+
 @routes.get(config.URL_PREFIX + 'history')
 async def history(request):
     history = { 'done': [], 'queue': []}
@@ -153,10 +225,80 @@ async def history(request):
 
     return web.Response(text=serializer.encode(history))
 
+@routes.get(config.URL_PREFIX + 'archive')
+@routes.post(config.URL_PREFIX + 'archive')
+async def archive(request):
+    if request.method == 'POST':
+        params = await request.json()
+        ids = params.get('ids')
+    else:
+        params = request.query
+        ids = params.getall('id', None)
+    folder = params.get('folder')
+    playlist = params.get('playlist')
+    format = params.get('format') or 'zip'
+    if format not in ARCHIVE_FORMATS or sum(x is not None for x in (ids, folder, playlist)) != 1:
+        raise web.HTTPBadRequest()
+    files = dqueue.get_completed_files(ids=set(ids) if ids is not None else None, folder=folder, playlist=playlist)
+    if not files:
+        raise web.HTTPNotFound()
+    members = []
+    for path, arcname in files:
+        try:
+            members.append(ArchiveMember(path, arcname))
+        except FileNotFoundError:
+            # Deleted since it was listed
+            continue
+    if not members:
+        raise web.HTTPNotFound()
+    name = os.path.basename(os.path.normpath(folder)) if folder else playlist
+    return await stream_archive(request, members, format, name or 'metube')
+
+if config.WORKER_TOKEN:
+    def check_worker_token(request):
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {config.WORKER_TOKEN}'):
+            raise web.HTTPUnauthorized()
+
+    @routes.post(config.URL_PREFIX + 'worker/lease')
+    async def worker_lease(request):
+        check_worker_token(request)
+        post = await request.json()
+        worker = post.get('worker')
+        if not worker:
+            raise web.HTTPBadRequest()
+        job = await dqueue.lease(worker)
+        if job is None:
+            return web.Response(status=204)
+        return web.Response(text=serializer.encode(job))
+
+    @routes.post(config.URL_PREFIX + 'worker/heartbeat')
+    async def worker_heartbeat(request):
+        check_worker_token(request)
+        post = await request.json()
+        lease = post.get('lease')
+        status = post.get('status')
+        if not lease or not isinstance(status, dict):
+            raise web.HTTPBadRequest()
+        if not await dqueue.heartbeat(lease, status):
+            raise web.HTTPGone()
+        return web.Response(text=serializer.encode({'status': 'ok'}))
+
+    @routes.post(config.URL_PREFIX + 'worker/complete')
+    async def worker_complete(request):
+        check_worker_token(request)
+        post = await request.json()
+        lease = post.get('lease')
+        status = post.get('status')
+        if not lease or not isinstance(status, dict):
+            raise web.HTTPBadRequest()
+        if not await dqueue.complete(lease, status):
+            raise web.HTTPGone()
+        return web.Response(text=serializer.encode({'status': 'ok'}))
+
 @sio.event
 async def connect(sid, environ):
     await sio.emit('all', serializer.encode(dqueue.get()), to=sid)
-    await sio.emit('configuration', serializer.encode(config), to=sid)
+    await sio.emit('configuration', serializer.encode({k: v for k, v in config.__dict__.items() if k not in config._PRIVATE}), to=sid)
     if config.CUSTOM_DIRS:
         await sio.emit('custom_dirs', serializer.encode(get_custom_dirs()), to=sid)
 
@@ -0,0 +1,254 @@
+import time
+import random
+import shelve
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from urllib.parse import urlparse
+import yt_dlp
+
+log = logging.getLogger('subscriptions')
+
+class Subscription:
+    def __init__(self, url, quality, format, folder, custom_name_prefix, interval):
+        self.url = url
+        self.quality = quality
+        self.format = format
+        self.folder = folder
+        self.custom_name_prefix = custom_name_prefix
+        self.interval = interval
+        self.title = None
+        self.last_checked = None
+        self.error = None
+        self.seen = set()
+        self.timestamp = time.time_ns()
+
+class SubscriptionManager:
+    """Periodically checks saved playlists and channels, and queues the entries which were not seen before.
+
+    The first check records the whole listing. Later checks stop at the first entry which was already
+    seen: listings known to put new uploads first (the tabs of a YouTube channel) are read lazily from
+    the start, so a check usually only fetches the first page, while other playlists are read from the
+    end, where new entries get appended.
+    """
+    def __init__(self, config, dqueue):
+        self.config = config
+        self.dqueue = dqueue
+        self.path = self.config.STATE_DIR + '/subscriptions'
+        with shelve.open(self.path, 'c') as shelf:
+            self.subscriptions = OrderedDict(sorted(shelf.items(), key=lambda item: item[1].timestamp))
+        self.tasks = {}
+        self.checking = set()
+        self.host_limits = {}
+
+    async def initialize(self):
+        for sub in self.subscriptions.values():
+            self.__schedule(sub, self.__first_delay(sub))
+
+    def __save(self, sub):
+        with shelve.open(self.path, 'w') as shelf:
+            shelf[sub.url] = sub
+
+    def __interval(self, sub):
+        return sub.interval or float(self.config.SUBSCRIPTION_INTERVAL)
+
+    def __jitter(self, sub):
+        return self.__interval(sub) * float(self.config.SUBSCRIPTION_JITTER) * random.uniform(-1, 1)
+
+    def __first_delay(self, sub):
+        # Spread checks which are due at startup, rather than hitting every site at once
+        if sub.last_checked is None:
+            due = 0
+        else:
+            due = max(sub.last_checked + self.__interval(sub) - time.time(), 0)
+        return due + abs(self.__jitter(sub))
+
+    def __schedule(self, sub, delay):
+        # A running check is left alone, cancelling it halfway could queue its entries again next time
+        if sub in self.checking:
+            return
+        if sub.url in self.tasks:
+            self.tasks[sub.url].cancel()
+        self.tasks[sub.url] = asyncio.create_task(self.__poll(sub, delay))
+
+    async def __poll(self, sub, delay):
+        while True:
+            await asyncio.sleep(delay)
+            if self.subscriptions.get(sub.url) is not sub:
+                return
+            try:
+                await self.check(sub)
+            except Exception as exc:
+                self.__check_failed(sub, exc)
+            if self.subscriptions.get(sub.url) is not sub:
+                return
+            delay = max(self.__interval(sub) + self.__jitter(sub), 0)
+
+    def __check_failed(self, sub, exc):
+        log.error(f'checking subscription {sub.url} failed: {exc!r}')
+        sub.error = str(exc) or repr(exc)
+        sub.last_checked = time.time()
+        if self.subscriptions.get(sub.url) is sub:
+            self.__save(sub)
+
+    def __host_limit(self, url):
+        host = (urlparse(url).hostname or '').removeprefix('www.')
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(int(self.config.SUBSCRIPTION_HOST_CONCURRENCY))
+        return self.host_limits[host]
+
+    def __extract_new_entries(self, sub):
+        ydl = yt_dlp.YoutubeDL(params={
+            'quiet': True,
+            'no_color': True,
+            'extract_flat': True,
+            'lazy_playlist': True,
+            'ignore_no_formats_error': True,
+            'paths': {"home": self.config.DOWNLOAD_DIR, "temp": self.config.TEMP_DIR},
+            **self.config.YTDL_OPTIONS,
+        })
+        info = self.__extract_playlist(ydl, sub.url)
+        playlist = yt_dlp.utils.PlaylistEntries(ydl, info)
+        first = next((entry for _, entry in playlist[:]), None)
+        if first and first.get('ie_key') == 'YoutubeTab':
+            # A channel URL without a tab lists the tabs of the channel (Videos, Shorts, ...), not its uploads
+            tabs = [entry for _, entry in itertools.islice(playlist[:], 20)]
+            uploads = next((tab for tab in tabs if tab and (tab.get('url') or '').rstrip('/').endswith('/videos')), None)
+            if uploads is None:
+                raise yt_dlp.utils.YoutubeDLError(f'"{sub.url}" lists playlists rather than videos, subscribe to one of them instead')
+            info = self.__extract_playlist(ydl, uploads['url'])
+            playlist = yt_dlp.utils.PlaylistEntries(ydl, info)
+        newest_first = self.__newest_first(info)
+        if sub.last_checked is None:
+            # Everything is new on the first check, take all of it so that none of it counts as new later
+            entries, limit, reverse = playlist[:], None, newest_first
+        elif newest_first:
+            entries, limit, reverse = playlist[:], int(self.config.SUBSCRIPTION_MAX_ENTRIES), True
+        else:
+            # Reading from the end needs the length of the listing, which most sites only give by listing it all
+            entries, limit, reverse = playlist[::-1], int(self.config.SUBSCRIPTION_MAX_ENTRIES), True
+        new_entries = []
+        for index, entry in itertools.islice(entries, limit):
+            if not entry or 'id' not in entry:
+                continue
+            if entry['id'] in sub.seen:
+                if sub.last_checked is None:
+                    continue
+                break
+            # Positions in a newest-first listing shift with every upload, only keep them for actual playlists
+            if not newest_first:
+                entry['playlist_index'] = index
+            new_entries.append(entry)
+        digits = len(str(playlist.get_full_count() or max((entry.get('playlist_index', 0) for entry in new_entries), default=0)))
+        for entry in new_entries:
+            if 'playlist_index' in entry:
+                entry['playlist_index'] = '{{0:0{0:d}d}}'.format(digits).format(entry['playlist_index'])
+        # Queue in playlist order, or the oldest uploads first
+        return info, new_entries[::-1] if reverse else new_entries
+
+    def __extract_playlist(self, ydl, url):
+        # Unprocessed results keep their entries as lazy iterators, which lets us stop early
+        info = ydl.extract_info(url, download=False, process=False)
+        while info and info.get('_type') in ('url', 'url_transparent'):
+            info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+        # With ignoreerrors in YTDL_OPTIONS, extraction errors come back as an empty result
+        if not info:
+            raise yt_dlp.utils.YoutubeDLError(f'Could not extract "{url}"')
+        if info.get('_type') != 'playlist':
+            raise yt_dlp.utils.YoutubeDLError(f'"{url}" is not a playlist or channel')
+        return info
+
+    def __newest_first(self, info):
+        # Channel tabs and the uploads playlist (UU...) of a YouTube channel list the latest uploads first
+        if info.get('extractor_key') != 'YoutubeTab':
+            return False
+        id = str(info.get('id') or '')
+        return id == info.get('channel_id') or id.startswith('UU')
+
+    async def check(self, sub, queue_entries=True):
+        self.checking.add(sub)
+        try:
+            return await self.__check(sub, queue_entries)
+        finally:
+            self.checking.discard(sub)
+
+    async def __check(self, sub, queue_entries):
+        async with self.__host_limit(sub.url):
+            log.info(f'checking subscription {sub.url}')
+            try:
+                info, entries = await asyncio.get_running_loop().run_in_executor(None, self.__extract_new_entries, sub)
+            except yt_dlp.utils.YoutubeDLError as exc:
+                info, entries = None, []
+                status = {'status': 'error', 'msg': str(exc)}
+                log.warn(f'checking subscription {sub.url} failed: {exc}')
+            else:
+                status = {'status': 'ok'}
+                sub.title = info.get('title')
+        if entries:
+            log.info(f'subscription {sub.url} has {len(entries)} new entries')
+        errors = []
+        for entry in entries:
+            if queue_entries:
+                entry['playlist'] = info.get('id')
+                for property in ('id', 'title', 'uploader', 'uploader_id'):
+                    if property in info:
+                        entry[f'playlist_{property}'] = info[property]
+                result = await self.dqueue.add_entry(entry, sub.quality, sub.format, sub.folder, sub.custom_name_prefix)
+                if result['status'] == 'error':
+                    errors.append(result.get('msg') or entry['id'])
+            # Entries which failed to queue are not retried, so that they don't fail again on every check
+            sub.seen.add(entry['id'])
+        if errors:
+            status = {'status': 'error', 'msg': ', '.join(errors)}
+        sub.error = status.get('msg')
+        sub.last_checked = time.time()
+        if self.subscriptions.get(sub.url) is sub:
+            self.__save(sub)
+        return status
+
+    async def subscribe(self, url, quality, format, folder, custom_name_prefix, interval, download_existing):
+        log.info(f'subscribing to {url}: {quality=} {format=} {folder=} {custom_name_prefix=} {interval=}')
+        sub = self.subscriptions.get(url)
+        if sub is None:
+            sub = Subscription(url, quality, format, folder, custom_name_prefix, interval)
+            # Validate the URL and remember what is already there, before saving the subscription
+            try:
+                status = await self.check(sub, queue_entries=download_existing)
+            except Exception as exc:
+                self.__check_failed(sub, exc)
+                status = {'status': 'error', 'msg': sub.error}
+            if sub.title is None and status['status'] == 'error':
+                return status
+        else:
+            sub.quality, sub.format, sub.folder, sub.custom_name_prefix, sub.interval = quality, format, folder, custom_name_prefix, interval
+            status = {'status': 'ok'}
+        self.subscriptions[url] = sub
+        self.__save(sub)
+        self.__schedule(sub, self.__interval(sub) + self.__jitter(sub))
+        return status
+
+    async def unsubscribe(self, ids):
+        for id in ids:
+            if id not in self.subscriptions:
+                log.warn(f'requested unsubscribe for non-existent subscription {id}')
+                continue
+            # A running check finishes first, its polling loop then notices the subscription is gone
+            task = self.tasks.pop(id, None)
+            if task is not None and self.subscriptions[id] not in self.checking:
+                task.cancel()
+            del self.subscriptions[id]
+            with shelve.open(self.path, 'w') as shelf:
+                shelf.pop(id)
+        return {'status': 'ok'}
+
+    async def check_now(self, ids):
+        for id in ids:
+            if id not in self.subscriptions:
+                log.warn(f'requested check for non-existent subscription {id}')
+                continue
+            self.__schedule(self.subscriptions[id], 0)
+        return {'status': 'ok'}
+
+    def get(self):
+        return [{k: v for k, v in vars(sub).items() if k != 'seen'} for sub in self.subscriptions.values()]
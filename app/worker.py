@@ -0,0 +1,134 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+import aiohttp
+from ytdl import DownloadQueueNotifier, DownloadInfo, Download, WORKER_STATUS_FIELDS
+from dl_formats import AUDIO_FORMATS
+
+log = logging.getLogger('worker')
+
+class WorkerNotifier(DownloadQueueNotifier):
+    # Progress is sent to the manager by the heartbeat loop, at its own pace
+    async def updated(self, dl):
+        pass
+
+class Worker:
+    """Pulls downloads from a central MeTube instance (the manager) and runs them locally.
+
+    Each job is leased from the manager's queue and has to be renewed by heartbeats, which also carry
+    the download progress. If the worker dies, the lease expires and the manager hands the download
+    to the next worker asking for one.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.id = config.WORKER_ID or f'{socket.gethostname()}-{os.getpid()}'
+        self.url = config.MANAGER_URL.rstrip('/') + '/worker/'
+        self.headers = {'Authorization': f'Bearer {config.WORKER_TOKEN}'}
+
+    async def __post(self, session, endpoint, data):
+        async with session.post(self.url + endpoint, json=data, headers=self.headers) as resp:
+            resp.raise_for_status()
+            if resp.status == 204:
+                return None
+            return await resp.json(content_type=None)
+
+    def __calc_download_path(self, job):
+        # Keep consistent with DownloadQueue; the manager has already validated the folder
+        base_directory = self.config.DOWNLOAD_DIR if (job['quality'] != 'audio' and job['format'] not in AUDIO_FORMATS) else self.config.AUDIO_DOWNLOAD_DIR
+        dldirectory = os.path.join(base_directory, job['folder']) if job['folder'] else base_directory
+        os.makedirs(dldirectory, exist_ok=True)
+        return dldirectory
+
+    def __status(self, dl):
+        return {k: getattr(dl.info, k, None) for k in WORKER_STATUS_FIELDS}
+
+    async def __heartbeat(self, session, job, dl):
+        interval = min(float(self.config.WORKER_HEARTBEAT_INTERVAL), job['timeout'] / 3)
+        while True:
+            try:
+                await self.__post(session, 'heartbeat', {'lease': job['lease'], 'status': self.__status(dl)})
+                job['renewed'] = time.monotonic()
+            except aiohttp.ClientResponseError as exc:
+                if exc.status == 410:
+                    log.info(f'lease for {job["title"]} is gone, canceling the download')
+                    dl.cancel()
+                    return
+                log.warn(f'heartbeat for {job["title"]} failed: {exc!r}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                log.warn(f'heartbeat for {job["title"]} failed: {exc!r}')
+            await asyncio.sleep(interval)
+
+    async def __run_job(self, session, job):
+        log.info(f'downloading {job["title"]}')
+        info = DownloadInfo(job['id'], job['title'], job['url'], job['quality'], job['format'], job['folder'], '', None, None)
+        dl = Download(self.__calc_download_path(job), self.config.TEMP_DIR, job['output_template'], job['output_template_chapter'],
+                      job['quality'], job['format'], self.config.YTDL_OPTIONS, info)
+        # Heartbeats go on until the result is reported, so the lease doesn't expire in between
+        heartbeat = asyncio.create_task(self.__heartbeat(session, job, dl))
+        try:
+            await dl.start(WorkerNotifier())
+            dl.close()
+            # Wait for the last progress updates (which carry the final filename) before reporting
+            await dl.status_task
+            if dl.info.status != 'finished':
+                if dl.tmpfilename and os.path.isfile(dl.tmpfilename):
+                    try:
+                        os.remove(dl.tmpfilename)
+                    except:
+                        pass
+                dl.info.status = 'error'
+            if dl.canceled:
+                return
+            await self.__complete(session, job, self.__status(dl), heartbeat)
+        finally:
+            heartbeat.cancel()
+
+    async def __complete(self, session, job, status, heartbeat=None):
+        """Reports the result of a job, retrying on connection and server errors for as long as its lease can be valid."""
+        title = job.get('title')
+        delay = 1
+        while True:
+            try:
+                await self.__post(session, 'complete', {'lease': job['lease'], 'status': status})
+                return
+            except aiohttp.ClientResponseError as exc:
+                if exc.status == 410:
+                    log.info(f'lease for {title} is gone, dropping its result')
+                    return
+                if exc.status < 500:
+                    log.error(f'reporting completion of {title} was rejected: {exc!r}')
+                    return
+                log.warn(f'reporting completion of {title} failed: {exc!r}')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                log.warn(f'reporting completion of {title} failed: {exc!r}')
+            except aiohttp.ClientError as exc:
+                log.error(f'reporting completion of {title} failed: {exc!r}')
+                return
+            if (heartbeat is not None and heartbeat.done()) or time.monotonic() - job['renewed'] > job.get('timeout', 0):
+                log.error(f'lease for {title} has expired, giving up reporting its result')
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def run(self):
+        log.info(f'worker {self.id} pulling downloads from {self.config.MANAGER_URL}')
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    job = await self.__post(session, 'lease', {'worker': self.id})
+                except aiohttp.ClientError as exc:
+                    log.warn(f'leasing a download failed: {exc!r}')
+                    job = None
+                if job is None:
+                    await asyncio.sleep(float(self.config.WORKER_POLL_INTERVAL))
+                    continue
+                job['renewed'] = time.monotonic()
+                try:
+                    await self.__run_job(session, job)
+                except Exception as exc:
+                    log.error(f'downloading {job.get("title")} failed: {exc!r}')
+                    # Report the failure, handing the job out again could just fail the same way elsewhere
+                    if 'lease' in job:
+                        await self.__complete(session, job, {'status': 'error', 'msg': str(exc) or repr(exc)})
@@ -7,11 +7,15 @@ import asyncio
 import multiprocessing
 import logging
 import re
+import uuid
 from dl_formats import get_format, get_opts, AUDIO_FORMATS
 from datetime import datetime
 
 log = logging.getLogger('ytdl')
 
+# Download info fields reported by remote workers while they work on a leased download
+WORKER_STATUS_FIELDS = ('status', 'msg', 'percent', 'speed', 'eta', 'filename')
+
 class DownloadQueueNotifier:
     async def added(self, dl):
         raise NotImplementedError
@@ -29,7 +33,7 @@ class DownloadQueueNotifier:
         raise NotImplementedError
 
 class DownloadInfo:
-    def __init__(self, id, title, url, quality, format, folder, custom_name_prefix, error):
+    def __init__(self, id, title, url, quality, format, folder, custom_name_prefix, error, playlist):
         self.id = id if len(custom_name_prefix) == 0 else f'{custom_name_prefix}.{id}'
         self.title = title if len(custom_name_prefix) == 0 else f'{custom_name_prefix}.{title}'
         self.url = url
@@ -41,6 +45,7 @@ class DownloadInfo:
         self.status = "pending"
         self.timestamp = time.time_ns()
         self.error = error
+        self.playlist = playlist
 
 class Download:
     manager = None
@@ -59,6 +64,8 @@ class Download:
         self.proc = None
         self.loop = None
         self.notifier = None
+        self.status_task = None
+        self.lease = None
 
 
     def _download(self):
@@ -109,7 +116,7 @@ class Download:
         self.notifier = notifier
         self.info.status = 'preparing'
         await self.notifier.updated(self.info)
-        asyncio.create_task(self.update_status())
+        self.status_task = asyncio.create_task(self.update_status())
         return await self.loop.run_in_executor(None, self.proc.join)
 
     def cancel(self):
@@ -153,6 +160,20 @@ class Download:
             self.info.eta = status.get('eta')
             await self.notifier.updated(self.info)
 
+class Lease:
+    def __init__(self, key, worker, timeout):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.worker = worker
+        self.timeout = timeout
+        self.renew()
+
+    def renew(self):
+        self.expires = time.monotonic() + self.timeout
+
+    def expired(self):
+        return time.monotonic() > self.expires
+
 class PersistentQueue:
     def __init__(self, path):
         pdir = os.path.dirname(path)
@@ -205,6 +226,7 @@ class DownloadQueue:
         self.queue = PersistentQueue(self.config.STATE_DIR + '/queue')
         self.done = PersistentQueue(self.config.STATE_DIR + '/completed')
         self.pending = PersistentQueue(self.config.STATE_DIR + '/pending')
+        self.leases = {}
         self.done.load()
 
     async def __import_queue(self):
@@ -213,7 +235,9 @@ class DownloadQueue:
 
     async def initialize(self):
         self.event = asyncio.Event()
-        asyncio.create_task(self.__download())
+        if self.config.LOCAL_DOWNLOADS:
+            asyncio.create_task(self.__download())
+        asyncio.create_task(self.__expire_leases())
         asyncio.create_task(self.__import_queue())
 
     def __extract_info(self, url):
@@ -226,9 +250,11 @@ class DownloadQueue:
             **self.config.YTDL_OPTIONS,
         }).extract_info(url, download=False)
 
-    def __calc_download_path(self, quality, format, folder):
+    def __calc_download_path(self, quality, format, folder, create=True):
         """Calculates download path from quality, format and folder attributes.
 
+        With create=False, a missing folder is neither created nor reported as an error.
+
         Returns:
             Tuple dldirectory, error_message both of which might be None (but not at the same time)
         """
@@ -241,7 +267,7 @@ class DownloadQueue:
             real_base_directory = os.path.realpath(base_directory)
             if not dldirectory.startswith(real_base_directory):
                 return None, {'status': 'error', 'msg': f'Folder "{folder}" must resolve inside the base download directory "{real_base_directory}"'}
-            if not os.path.isdir(dldirectory):
+            if create and not os.path.isdir(dldirectory):
                 if not self.config.CREATE_CUSTOM_DIRS:
                     return None, {'status': 'error', 'msg': f'Folder "{folder}" for download does not exist inside base directory "{real_base_directory}", and CREATE_CUSTOM_DIRS is not true in the configuration.'}
                 os.makedirs(dldirectory, exist_ok=True)
@@ -278,8 +304,13 @@ class DownloadQueue:
                 return {'status': 'error', 'msg': ', '.join(res['msg'] for res in results if res['status'] == 'error' and 'msg' in res)}
             return {'status': 'ok'}
         elif etype == 'video' or etype.startswith('url') and 'id' in entry and 'title' in entry:
+            url = entry.get('webpage_url') or entry['url']
+            # Replacing a download which is running (here or on a worker) would orphan it
+            if self.queue.exists(url) and (self.queue.get(url).lease is not None or self.queue.get(url).started()):
+                log.info(f'{url} is already being downloaded, skipping')
+                return {'status': 'ok'}
             if not self.queue.exists(entry['id']):
-                dl = DownloadInfo(entry['id'], entry['title'], entry.get('webpage_url') or entry['url'], quality, format, folder, custom_name_prefix, error)
+                dl = DownloadInfo(entry['id'], entry['title'], url, quality, format, folder, custom_name_prefix, error, entry.get('playlist'))
                 dldirectory, error_message = self.__calc_download_path(quality, format, folder)
                 if error_message is not None:
                     return error_message
@@ -313,6 +344,10 @@ class DownloadQueue:
             return {'status': 'error', 'msg': str(exc)}
         return await self.__add_entry(entry, quality, format, folder, custom_name_prefix, auto_start, already)
 
+    async def add_entry(self, entry, quality, format, folder, custom_name_prefix, auto_start=True):
+        """Queues an entry which was already extracted, e.g. the new entries of a subscription."""
+        return await self.__add_entry(entry, quality, format, folder, custom_name_prefix, auto_start, set())
+
     async def start_pending(self, ids):
         for id in ids:
             if not self.pending.exists(id):
@@ -332,6 +367,7 @@ class DownloadQueue:
             if self.queue.get(id).started():
                 self.queue.get(id).cancel()
             else:
+                self.__release_lease(self.queue.get(id))
                 self.queue.delete(id)
                 await self.notifier.canceled(id)
         return {'status': 'ok'}
@@ -352,17 +388,164 @@ class DownloadQueue:
             await self.notifier.cleared(id)
         return {'status': 'ok'}
 
+    def get_completed_files(self, ids=None, folder=None, playlist=None):
+        """Lists the files of finished downloads selected by id, by folder or by playlist id.
+
+        Returns:
+            List of (path, name) tuples, name being the path of the file relative to the base download directory
+        """
+        files = []
+        seen = set()
+        for id, dl in self.done.items():
+            if ids is not None and id not in ids:
+                continue
+            if folder is not None and (dl.info.folder or '') != folder:
+                continue
+            if playlist is not None and getattr(dl.info, 'playlist', None) != playlist:
+                continue
+            if dl.info.status != 'finished' or not getattr(dl.info, 'filename', None):
+                continue
+            dldirectory, _ = self.__calc_download_path(dl.info.quality, dl.info.format, dl.info.folder, create=False)
+            if dldirectory is None:
+                continue
+            path = os.path.join(dldirectory, dl.info.filename)
+            if path in seen or not os.path.isfile(path):
+                continue
+            seen.add(path)
+            files.append((path, os.path.join(dl.info.folder or '', dl.info.filename)))
+        return files
+
     def get(self):
         return(list((k, v.info) for k, v in self.queue.items()) + list((k, v.info) for k, v in self.pending.items()),
                list((k, v.info) for k, v in self.done.items()))
 
+    async def lease(self, worker):
+        """Hands the next queued download over to a remote worker.
+
+        Returns:
+            The job description to send to the worker, or None if there is nothing to download
+        """
+        id, entry = self.__next_available()
+        if entry is None:
+            return None
+        lease = Lease(id, worker, float(self.config.WORKER_LEASE_TIMEOUT))
+        self.leases[lease.id] = lease
+        entry.lease = lease
+        entry.info.worker = worker
+        entry.info.status = 'preparing'
+        log.info(f'leased {entry.info.title} to worker {worker}')
+        await self.notifier.updated(entry.info)
+        return {
+            'lease': lease.id,
+            'timeout': lease.timeout,
+            'id': entry.info.id,
+            'title': entry.info.title,
+            'url': entry.info.url,
+            'quality': entry.info.quality,
+            'format': entry.info.format,
+            'folder': entry.info.folder,
+            'output_template': entry.output_template,
+            'output_template_chapter': entry.output_template_chapter,
+        }
+
+    async def heartbeat(self, lease_id, status):
+        """Renews a lease and applies the progress reported by its worker.
+
+        Returns:
+            False if the lease is unknown (expired, canceled or lost on restart) and the worker should give up
+        """
+        entry = self.__leased_entry(lease_id)
+        if entry is None:
+            return False
+        entry.lease.renew()
+        self.__apply_worker_status(entry, status)
+        await self.notifier.updated(entry.info)
+        return True
+
+    async def complete(self, lease_id, status):
+        entry = self.__leased_entry(lease_id)
+        if entry is None:
+            return False
+        id = entry.lease.key
+        self.__release_lease(entry)
+        if not self.__apply_worker_status(entry, status):
+            entry.info.status = 'error'
+            entry.info.msg = 'Worker reported a file outside of the download directory'
+        if entry.info.status != 'finished':
+            entry.info.status = 'error'
+        log.info(f'worker {entry.info.worker} completed {entry.info.title} with status {entry.info.status}')
+        await self.__finish(id, entry)
+        return True
+
+    def __leased_entry(self, lease_id):
+        lease = self.leases.get(lease_id)
+        if lease is None or not self.queue.exists(lease.key) or self.queue.get(lease.key).lease is not lease:
+            return None
+        return self.queue.get(lease.key)
+
+    def __release_lease(self, entry):
+        if entry.lease is not None:
+            self.leases.pop(entry.lease.id, None)
+            entry.lease = None
+
+    def __apply_worker_status(self, entry, status):
+        """Copies the reported fields onto the download info.
+
+        Returns:
+            False if the reported filename was rejected for resolving outside of the download directory
+        """
+        filename = status.get('filename')
+        # The filename is only known at the very end, don't let earlier reports erase it
+        if filename:
+            real_directory = os.path.realpath(entry.download_dir)
+            if not isinstance(filename, str) or not os.path.realpath(os.path.join(real_directory, filename)).startswith(real_directory + os.sep):
+                log.warn(f'worker {entry.info.worker} reported invalid filename {filename!r} for {entry.info.title}')
+                return False
+            entry.info.filename = filename
+        for k in WORKER_STATUS_FIELDS:
+            if k in status and k != 'filename':
+                setattr(entry.info, k, status[k])
+        return True
+
+    async def __expire_leases(self):
+        while True:
+            await asyncio.sleep(1)
+            for lease in [lease for lease in self.leases.values() if lease.expired()]:
+                log.warn(f'lease {lease.id} of worker {lease.worker} expired')
+                del self.leases[lease.id]
+                if not self.queue.exists(lease.key) or self.queue.get(lease.key).lease is not lease:
+                    continue
+                entry = self.queue.get(lease.key)
+                entry.lease = None
+                entry.info.status = 'pending'
+                entry.info.msg = entry.info.percent = entry.info.speed = entry.info.eta = entry.info.worker = None
+                await self.notifier.updated(entry.info)
+                self.event.set()
+
+    def __next_available(self):
+        for id, entry in self.queue.items():
+            if entry.lease is None and not entry.started():
+                return id, entry
+        return None, None
+
+    async def __finish(self, id, entry):
+        entry.close()
+        if self.queue.exists(id):
+            self.queue.delete(id)
+            if entry.canceled:
+                await self.notifier.canceled(id)
+            else:
+                self.done.put(entry)
+                await self.notifier.completed(entry.info)
+
     async def __download(self):
         while True:
-            while self.queue.empty():
+            id, entry = self.__next_available()
+            while entry is None:
                 log.info('waiting for item to download')
                 await self.event.wait()
                 self.event.clear()
-            id, entry = self.queue.next()
+                id, entry = self.__next_available()
             log.info(f'downloading {entry.info.title}')
             await entry.start(self.notifier)
             if entry.info.status != 'finished':
@@ -372,11 +555,4 @@ class DownloadQueue:
                     except:
                         pass
                 entry.info.status = 'error'
-            entry.close()
-            if self.queue.exists(id):
-                self.queue.delete(id)
-                if entry.canceled:
-                    await self.notifier.canceled(id)
-                else:
-                    self.done.put(entry)
-                    await self.notifier.completed(entry.info)
+            await self.__finish(id, entry)